@@ -15,14 +15,25 @@ Images and Files are downloaded as well.
 ##
 
 import argparse
+import contextlib
+import cProfile
+import pstats
+import time
+import tracemalloc
 import requests
 import gzip
+import zlib
 import simplejson as json
 #import ujson as json
 import datetime
-import shutil
 import sys
 import os
+import re
+import hashlib
+import mmap
+import queue
+import threading
+import concurrent.futures
 from pathlib import Path
 
 #import traceback
@@ -35,6 +46,19 @@ from pathlib import Path
 from fpdf import FPDF, TitleStyle, Align
 from fpdf.enums import FileAttachmentAnnotationName 
 
+# orjson is optional, a faster parser for the post pages
+try:
+    import orjson
+    loadPostsJson = orjson.loads
+except ImportError:
+    loadPostsJson = json.loads
+
+# zstandard is optional, only needed for --json-compression zstd
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 __author__ = 'Alexander J. Lallier'
 __version__ = '1.0'
 __contact__ = ''
@@ -54,6 +78,43 @@ baseUserPath = ''
 users = {}
 channelCache = {}
 
+# Post fields the PDF renderer reads, everything else is left in the raw page
+renderPostFields = ( 'message', 'user_id', 'create_at', 'is_pinned' )
+
+# Conditional HTTP cache, disabled when httpCacheDir is empty
+httpCacheDir = ''
+httpCacheStats = { 'hits': 0, 'misses': 0 }
+httpCacheLock = threading.Lock()
+
+# Channel type to category section title
+channelCategories = {
+    'O': 'PUBLIC CHANNELS',
+    'P': 'PRIVATE CHANNELS',
+    'D': 'DIRECT MESSAGE CHANNELS',
+    'G': 'GROUP MESSAGE CHANNELS'
+}
+
+# Attachment download manifest, keyed by path relative to the files directory
+attachmentManifest = {}
+attachmentManifestName = 'manifest.json'
+attachmentHashBlockSize = 16 * 1024 * 1024
+
+# Profiling, disabled when profileDir is empty
+profileDir = ''
+profileTopN = 25
+profileSampledChannels = {}   # channel id -> directory for per channel results
+profilePhases = {}            # (phase, channel directory) -> cProfile.Profile
+profileTimings = {}           # phase -> [calls, seconds, traced memory delta]
+profileStack = []
+
+# JSON archive block compression
+jsonArchiveReadErrors = (OSError, ValueError, EOFError, zlib.error)
+if zstandard is not None:
+    jsonArchiveReadErrors += (zstandard.ZstdError,)
+jsonBlockSize = 4 * 1024 * 1024
+jsonCodecExtensions = { 'gzip': 'gz', 'pigz': 'gz', 'zstd': 'zst' }
+jsonCodecDefaultLevels = { 'gzip': 9, 'pigz': 9, 'zstd': 3 }
+jsonCodecLevelRanges = { 'gzip': (0, 9), 'pigz': (0, 9), 'zstd': (1, 22) }
 
 channelDisplayName = ''
 messageHeader = None
@@ -101,6 +162,10 @@ class ChannelMembersException( Exception ):
     def __init__(self, message = None ):
         super(ChannelMembersException,self).__init__(message)
 
+class JsonArchiveException( Exception ):
+    def __init__(self, message = None ):
+        super(JsonArchiveException,self).__init__(message)
+
 
 #########################
 ## MMExport2PDF Options
@@ -128,12 +193,13 @@ def processOptions():
                                          formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
         usergroup = parser.add_argument_group(title='User Info')
-        usergroup.add_argument("-a", "--auth", help="Auth Token", action="store", dest="auth", required=True)
+        usergroup.add_argument("-a", "--auth", help="Auth Token, not needed with --json-read", action="store", dest="auth")
         usergroup.add_argument("-u", "--user", help="Username of user to be exported", action="store", dest="user", required=True)
-        usergroup.add_argument("-t", "--team", help="Team to export from", action="store", dest="team", required=True)
+        usergroup.add_argument("-t", "--team", help="Team to export from, not needed with --json-read", action="store", dest="team")
 
         servergroup = parser.add_argument_group(title='Server Info')
         servergroup.add_argument("-s", "--server", help="Hostname or IP of the server", action="store", dest="server", default="mattermost.com")
+        servergroup.add_argument("-c", "--http-cache", help="Directory for the ETag HTTP cache, repeat exports only download changed posts, channels and users", action="store", dest="httpCache", default=None)
 
         categorygroup = parser.add_argument_group(title='Channel Categories')
         categorygroup.add_argument("-p", "--public", help="Exclude public channels", action="store_true", dest="public")
@@ -150,9 +216,30 @@ def processOptions():
         exportgroup.add_argument("-f", "--files", help="Embed files in PDF", action="store_true", dest="files")
         exportgroup.add_argument("-j", "--json", help="Export JSON", action="store_true", dest="json")
         exportgroup.add_argument("-o", "--output", help="Base output directory", action="store", dest="output", default='./users')
+        exportgroup.add_argument("--volume-pages", help="Start a new PDF volume at the next channel once a volume reaches this many pages, 0 for no limit", type=int, action="store", dest="volumePages", default=0)
+        exportgroup.add_argument("--volume-size", help="Start a new PDF volume at the next channel once a volume has buffered this many MB of uncompressed page content, images and files, 0 for no limit. The written file is usually smaller", type=float, action="store", dest="volumeSize", default=0)
+        exportgroup.add_argument("-V", "--verify", help="Verify downloaded images and files against the manifest, redownload bad or missing ones and exit", action="store_true", dest="verify")
+        exportgroup.add_argument("--profile", help="Write cProfile stats and tracemalloc snapshots per export phase to <output>/<user>/profile. Per channel phases get a snapshot of their first call only, see --profile-channels. Channels are fetched serially while profiling", action="store_true", dest="profile")
+        exportgroup.add_argument("--profile-top", help="Number of allocation sites in each tracemalloc snapshot", type=int, action="store", dest="profileTop", default=25)
+        exportgroup.add_argument("--profile-channels", help="Also profile every Nth channel on its own, with a snapshot of each of its phases except attachments, 0 for none", type=int, action="store", dest="profileChannels", default=0)
+        exportgroup.add_argument("-F", "--prefetch", help="Number of channels to fetch ahead of the PDF renderer, 0 fetches serially", type=int, action="store", dest="prefetch", default=2)
+
+        jsongroup = parser.add_argument_group(title='JSON Archive Options')
+        jsongroup.add_argument("--json-compression", help="Compression for the JSON archive. pigz writes parallel concatenated gzip, zstd needs the zstandard module", choices=list(jsonCodecExtensions), dest="jsonCompression", default='gzip')
+        jsongroup.add_argument("--json-level", help="Compression level, lower is faster, higher is smaller. Defaults to 9 for gzip/pigz and 3 for zstd", type=int, action="store", dest="jsonLevel", default=argparse.SUPPRESS)
+        jsongroup.add_argument("--json-threads", help="Worker threads for block compression and --json-read, 0 uses all CPUs", type=int, action="store", dest="jsonThreads", default=0)
+        jsongroup.add_argument("--json-read", help="Read back an existing JSON archive with --json-threads workers, print its channels and exit", action="store_true", dest="jsonRead")
 
         options = parser.parse_args() # uses sys.argv[1:] by default
 
+        # Suppressed so the help shows the per codec defaults instead of None
+        if not hasattr(options, 'jsonLevel'):
+            options.jsonLevel = None
+
+        # Reading back a local archive never contacts the server
+        if not options.jsonRead and not (options.auth and options.team):
+            parser.error('the following arguments are required: -a/--auth, -t/--team')
+
 
     except Exception as e: #pylint: disable=broad-except
         raise OptionsException( e )
@@ -170,16 +257,37 @@ def main():
         global baseUserPath
         global mattermostURL
         global headers
+        global httpCacheDir
+        global channelDisplayName
+        global profileDir
+        global profileTopN
 
         options = processOptions()
 
         if (options.public and options.private and options.group and options.dms):
             raise OptionsException( 'At least one channel category must be exported' )
 
+        if ((options.json or options.jsonRead) and options.jsonCompression == 'zstd' and zstandard is None):
+            raise OptionsException( 'zstd compression requires the zstandard module' )
+
+        if options.json and options.jsonLevel is not None:
+            minLevel, maxLevel = jsonCodecLevelRanges[options.jsonCompression]
+            if not (minLevel <= options.jsonLevel <= maxLevel):
+                raise OptionsException( f'--json-level for {options.jsonCompression} must be between {minLevel} and {maxLevel}' )
+
+        if options.jsonRead:
+            baseUserPath = os.path.join( options.output, options.user )
+            printJsonFileSummary(options.user, options.jsonCompression, options.jsonThreads)
+            return
+
         # Setup
         mattermostURL = f'https://{options.server}/api/v4/'
         headers['Authorization'] = f'Bearer {options.auth}'
 
+        if options.httpCache:
+            httpCacheDir = options.httpCache
+            os.makedirs( httpCacheDir, 0o755, True)
+
         userInfo = getUserFromName(options.user)
         teamInfo = getTeam(options.team)
 
@@ -188,9 +296,25 @@ def main():
 
         os.makedirs( baseUserPath, 0o755, True)
 
+        loadAttachmentManifest(baseUserFilePath)
+
+        if options.verify:
+            verifyAttachments(baseUserFilePath)
+            return
+
+        if options.profile:
+            profileDir = os.path.join( baseUserPath, 'profile' )
+            profileTopN = options.profileTop
+            os.makedirs( profileDir, 0o755, True)
+            tracemalloc.start()
+
+            # Phases must not overlap across threads while profiling
+            options.prefetch = 0
+
         # Start Working
-        allChannelsForUser = getChannelsForAUser(userInfo['id'], teamInfo['id'])
-        allChannelsForUser.reverse()
+        with profilePhase('channel-listing'):
+            allChannelsForUser = getChannelsForAUser(userInfo['id'], teamInfo['id'])
+            allChannelsForUser.reverse()
 
 
         hitPublicChannel = False
@@ -198,10 +322,13 @@ def main():
         hitDMChannel = False
         hitGroupMessages = False
 
+        # Volumes are only used when a page or size cap is given
+        useVolumes = options.volumePages > 0 or options.volumeSize > 0
+        volumeNumber = 1
+        volumeIndex = { "volumes": [], "channels": [] }
+
         # Initialize PDF
-        pdf = PDF()
-        pdf.add_page()
-        pdf.set_auto_page_break(True, 15.0)
+        pdf = newPDF()
 
         publicChannels = []
         privateChannels = []
@@ -226,8 +353,9 @@ def main():
                         groupChannels.append(channel)
 
         # Pre-process names in direct messages so we can sort by the other user's name
-        for channel in directMessageChannels:
-            channel['full_name'] = directMessageOtherUserName(channel, userInfo['id'])
+        with profilePhase('user-resolution'):
+            for channel in directMessageChannels:
+                channel['full_name'] = directMessageOtherUserName(channel, userInfo['id'])
 
         # Sort alphabetical
 
@@ -240,255 +368,346 @@ def main():
         
         if not channelGroupingsList:
             raise ChannelPostsException( "No posts matched the export criteria" )
+
+        if profileDir and options.profileChannels > 0:
+            for channelIndex, channel in enumerate(channelGroupingsList):
+                if channelIndex % options.profileChannels == 0:
+                    profileSampledChannels[channel["id"]] = os.path.join( profileDir, 'channels', f'{channelIndex:04d}-{channel["id"]}' )
         
-        for channel in channelGroupingsList:
+        for channel, allPostsFull, allPosts in iterFetchedChannels(channelGroupingsList, options.prefetch):
 
             messagesArray = []
             pinnedMessages = []
 
+            # Split at channel boundaries once the current volume is full.
+            # This runs before the next channel's name is set up so the
+            # closing page keeps the header of the volume's last channel
+            volumeHasChannels = bool(volumeIndex["channels"]) and volumeIndex["channels"][-1]["volume"] == volumeNumber
+            if useVolumes and volumeHasChannels and volumeIsFull(pdf, options.volumePages, options.volumeSize):
+                pdfOutput = os.path.join(baseUserPath, f'{options.user}-vol{volumeNumber:02d}.pdf' )
+                volumeIndex["volumes"].append({ "volume": volumeNumber, "file": os.path.basename(pdfOutput), "pages": pdf.page_no() + 1 })
+                writePDF(pdf, pdfOutput)
+
+                # Drop the finished volume before laying out the next one,
+                # its first page has no channel header like the first volume
+                del pdf
+                channelDisplayName = ''
+                pdf = newPDF()
+                volumeNumber += 1
+
+                hitPublicChannel = False
+                hitPrivateChannel = False
+                hitDMChannel = False
+                hitGroupMessages = False
+
             # Setup Channel Name and Headers for printing
-            setupChannelNameAndHeader(channel, userInfo['id'])
+            with profilePhase('user-resolution', channel):
+                setupChannelNameAndHeader(channel, userInfo['id'])
 
             if (channel["type"] == 'O' and hitPublicChannel == False):
                 pdf.set_fill_color(255, 165, 0)
-                pdf.start_section("PUBLIC CHANNELS")
+                pdf.start_section(channelCategories['O'])
                 hitPublicChannel = True
 
             if (channel["type"] == 'P' and hitPrivateChannel == False):
                 pdf.set_fill_color(255, 165, 0)
-                pdf.start_section("PRIVATE CHANNELS")
+                pdf.start_section(channelCategories['P'])
                 hitPrivateChannel = True
 
             if (channel["type"] == 'D' and hitDMChannel == False):
                 pdf.set_fill_color(255, 165, 0)
-                pdf.start_section("DIRECT MESSAGE CHANNELS")
+                pdf.start_section(channelCategories['D'])
                 hitDMChannel = True
 
             if (channel["type"] == 'G' and hitGroupMessages == False):
                 pdf.set_fill_color(255, 165, 0)
-                pdf.start_section("GROUP MESSAGE CHANNELS")
+                pdf.start_section(channelCategories['G'])
                 hitGroupMessages = True
 
             print(channelDisplayName)
             # File_object.write("## " + channelDisplayName + '\n\n')
             pdf.set_fill_color(255, 0, 0)
             pdf.start_section(channelDisplayName, level=1)
+            volumeIndex["channels"].append({
+                "category": channelCategories[channel["type"]],
+                "channel": channelDisplayName,
+                "volume": volumeNumber,
+                "page": pdf.page_no()
+            })
             # pdf.set_link(tableOfContents[channel["display_name"]])
             # pdf.multi_cell(0, 5, messageHeader, 0, 'L', True)
             # pdf.ln()
 
             channelId = channel["id"]
 
-            morePages = True
-            channelPostsCounter = 0
-            allPosts = []
-            allPostsFull = []
-            # Get all pages and append messages to one array.
-            # We reverse this array before processing so order is from older to newest when printing
-
-            while (morePages):
-
-                allPostsForChannel = getPostsForChannel(channelId, channelPostsCounter)
-
-                postFiles = []
-
-                if not allPostsForChannel["posts"]:
-                    morePages = False
-
-                channelPostsCounter += 1
-
-                for key in allPostsForChannel["order"]:
-                    allPosts.append(allPostsForChannel["posts"][key])
-
-                allPostsFull.append(allPostsForChannel)
-
-            # CACHE CHANNEL HERE
-            channelCache[channelId] = {
-                "channelName": channelDisplayName,
-                "posts": allPostsFull
-            }
-
-            # Reverse so it prints oldest to newest
-            allPosts.reverse()
-
-            # BEGIN POST PROCESSING
-            # Loop over posts for channel
-            for post in allPosts:
-                pictures = []
-                files = []
-
-                message = post["message"]
-                if (isinstance(message, str)):
-                    postUserId = post["user_id"]
-
-                    theUser = getUser(postUserId)
-
-                    # Files
-                    if "metadata" in post and "files" in post["metadata"]:
-                        postFiles = post["metadata"]["files"]
-
-                        if len(postFiles) > 0:
-                            for file in postFiles:
-                                # file["extension"] == "gif"
-                                if file["extension"].lower() in imageExtenstions:
-                                    pictures.append(file)
-                                else:
-                                    files.append(file)
-
-                    postWithUserName = {
-                        "name": theUser["first_name"] + " " + theUser["last_name"],
-                        "message": message,
-                        "time": str(datetime.datetime.fromtimestamp(post["create_at"] / 1000).strftime("%m/%d/%Y, %I:%M:%S %p")),
-                        "pictures": pictures,
-                        "files": files,
-                        "post": post
-                    }
-
-                    if post["is_pinned"] == True:
-                        pinnedMessages.append(postWithUserName)
-
-                    messagesArray.append(postWithUserName)
+            # CACHE CHANNEL HERE, only the JSON archive needs the raw pages
+            if( options.json ):
+                channelCache[channelId] = {
+                    "channelName": channelDisplayName,
+                    "posts": allPostsFull
+                }
+
+            with profilePhase('post-processing', channel):
+                # BEGIN POST PROCESSING
+                # Loop over posts for channel
+                for post in allPosts:
+                    pictures = []
+                    files = []
+
+                    message = post["message"]
+                    if (isinstance(message, str)):
+                        postUserId = post["user_id"]
+
+                        theUser = getUser(postUserId)
+
+                        # Files
+                        if "metadata" in post and "files" in post["metadata"]:
+                            postFiles = post["metadata"]["files"]
+
+                            if len(postFiles) > 0:
+                                for file in postFiles:
+                                    # file["extension"] == "gif"
+                                    if file["extension"].lower() in imageExtenstions:
+                                        pictures.append(file)
+                                    else:
+                                        files.append(file)
+
+                        postWithUserName = {
+                            "name": theUser["first_name"] + " " + theUser["last_name"],
+                            "message": message,
+                            "time": str(datetime.datetime.fromtimestamp(post["create_at"] / 1000).strftime("%m/%d/%Y, %I:%M:%S %p")),
+                            "pictures": pictures,
+                            "files": files,
+                            "post": post
+                        }
+
+                        if post["is_pinned"] == True:
+                            pinnedMessages.append(postWithUserName)
+
+                        messagesArray.append(postWithUserName)
 
             print('Total Messages: ', len(messagesArray) + 1)
             print('\n')
 
-            if len(pinnedMessages) > 0:
-                pdf.start_section("Pinned Messages", level=2)
+            with profilePhase('pdf-layout', channel):
+                if len(pinnedMessages) > 0:
+                    pdf.start_section("Pinned Messages", level=2)
 
-            # Loop through Pinned messages first, to put them all at the front
-            for message in pinnedMessages:
-                userName = message["name"]
-                singleMessage = message["message"]
-                time = message["time"]
+                # Loop through Pinned messages first, to put them all at the front
+                for message in pinnedMessages:
+                    userName = message["name"]
+                    singleMessage = message["message"]
+                    postTime = message["time"]
 
-                #pdf.set_fill_color(220, 220, 220)
-                pdf.set_fill_color(255, 165, 0)
-                pdf.set_draw_color(255, 165, 0)
-                pdf.cell(0, 5, f'{handleUnicode(userName)} {time} Pinned', 0, align='L', fill=True)
-                pdf.set_fill_color(255, 255, 255)
-                pdf.ln()
-                pdf.multi_cell(0, 5, handleUnicode(singleMessage), 1, align='L', fill=True, markdown=True)
-                # pdf.write_html(marko.convert(singleMessage))
-                pdf.ln()
-
-            pdf.set_draw_color(0, 0, 0)
-            pdf.set_fill_color(220, 220, 220)
-            pdf.start_section("Regular Messages", level=2)
-
-            pdf.set_fill_color(255, 255, 255)
-            for message in messagesArray:
-                userName = message["name"]
-                singleMessage = message["message"]
-                time = message["time"]
-                post = message["post"]
-
-                if post["is_pinned"] == True:
+                    #pdf.set_fill_color(220, 220, 220)
                     pdf.set_fill_color(255, 165, 0)
                     pdf.set_draw_color(255, 165, 0)
-                    pdf.cell(0, 5, f'{handleUnicode(userName)} {time} Pinned', 0, align='L', fill=True)
+                    pdf.cell(0, 5, f'{handleUnicode(userName)} {postTime} Pinned', 0, align='L', fill=True)
                     pdf.set_fill_color(255, 255, 255)
-
                     pdf.ln()
                     pdf.multi_cell(0, 5, handleUnicode(singleMessage), 1, align='L', fill=True, markdown=True)
-                    pdf.ln()
-                    pdf.set_draw_color(0, 0, 0)
-                else:
-                    pdf.set_fill_color(220, 220, 220)
-                    pdf.cell(0, 5, f'{handleUnicode(userName)} {time}', 0, align='L', fill=True)
-                    pdf.set_fill_color(255, 255, 255)
-                    pdf.ln()
-                    pdf.multi_cell(0, 5, handleUnicode(singleMessage), 0, align='L', fill=True, markdown=True)
+                    # pdf.write_html(marko.convert(singleMessage))
                     pdf.ln()
 
+                pdf.set_draw_color(0, 0, 0)
+                pdf.set_fill_color(220, 220, 220)
+                pdf.start_section("Regular Messages", level=2)
 
-                if( options.images ):
-                    try:
-                        userPicturesFilePath = os.path.join( baseUserFilePath, "pics/" )
-                        os.makedirs( userPicturesFilePath, 0o755, True)
+                pdf.set_fill_color(255, 255, 255)
+                for message in messagesArray:
+                    userName = message["name"]
+                    singleMessage = message["message"]
+                    postTime = message["time"]
+                    post = message["post"]
 
-                        for picture in message["pictures"]:
+                    if post["is_pinned"] == True:
+                        pdf.set_fill_color(255, 165, 0)
+                        pdf.set_draw_color(255, 165, 0)
+                        pdf.cell(0, 5, f'{handleUnicode(userName)} {postTime} Pinned', 0, align='L', fill=True)
+                        pdf.set_fill_color(255, 255, 255)
+
+                        pdf.ln()
+                        pdf.multi_cell(0, 5, handleUnicode(singleMessage), 1, align='L', fill=True, markdown=True)
+                        pdf.ln()
+                        pdf.set_draw_color(0, 0, 0)
+                    else:
+                        pdf.set_fill_color(220, 220, 220)
+                        pdf.cell(0, 5, f'{handleUnicode(userName)} {postTime}', 0, align='L', fill=True)
+                        pdf.set_fill_color(255, 255, 255)
+                        pdf.ln()
+                        pdf.multi_cell(0, 5, handleUnicode(singleMessage), 0, align='L', fill=True, markdown=True)
+                        pdf.ln()
+
+
+                    # Only profile messages that actually have attachments to handle
+                    hasAttachments = (options.images and message["pictures"]) or (options.files and message["files"])
+                    with (profilePhase('attachments', channel) if hasAttachments else contextlib.nullcontext()):
+                        if( options.images ):
                             try:
-                                # APPEND FILE ID TO PATH TO MAKE UNIQUE AND CACHE THIS
-                                imagePath = os.path.join( userPicturesFilePath,  f'{picture["id"]}_{picture["name"]}' )
-                                myImage = Path(imagePath)
+                                userPicturesFilePath = os.path.join( baseUserFilePath, "pics/" )
+                                os.makedirs( userPicturesFilePath, 0o755, True)
 
-                                if not myImage.exists():
-                                    imageObj = getFile( picture["id"] )
+                                for picture in message["pictures"]:
+                                    try:
+                                        # APPEND FILE ID TO PATH TO MAKE UNIQUE AND CACHE THIS
+                                        imagePath = os.path.join( userPicturesFilePath,  f'{picture["id"]}_{picture["name"]}' )
 
-                                    with open(imagePath, 'wb') as f:
-                                        imageObj.raw.decode_content = True
-                                        shutil.copyfileobj(imageObj.raw, f)
+                                        ensureAttachment( picture, baseUserFilePath, imagePath )
 
-                                pdf.image(imagePath, w=(pdf.epw * .75), x=Align.C)
+                                        pdf.image(imagePath, w=(pdf.epw * .75), x=Align.C)
+
+                                    except ImageException as ie:
+                                        print( f'Embed Image error: {ie}' )
+                                        #traceback.print_exc()
+                                    except Exception as e:
+                                        print('Embed Image error: Couldn\'t add picture to PDF')
+                                        print( e )
+                                        #traceback.print_exc()
 
                             except ImageException as ie:
-                                print( f'Embed Image error: {ie}' )
-                                #traceback.print_exc()
-                            except Exception as e:
-                                print('Embed Image error: Couldn\'t add picture to PDF')
-                                print( e )
-                                #traceback.print_exc()
-
-                    except ImageException as ie:
-                        print( ie )
-
-                if( options.files ):
-                    try:
-                        userAttachmentsFilePath = os.path.join( baseUserFilePath, "files/" )
-                        os.makedirs( userAttachmentsFilePath, 0o755, True)
-
-                        for aFile in message["files"]:
+                                print( ie )
+
+                        if( options.files ):
                             try:
-                                filePath = os.path.join( userAttachmentsFilePath, f'{aFile["id"]}_{aFile["name"]}' )
-                                myFile = Path(filePath)
-
-                                if not myFile.exists():
-                                    fileObj = getFile( aFile["id"] )
-
-                                    with open(filePath, 'wb') as f:
-                                        fileObj.raw.decode_content = True
-                                        shutil.copyfileobj(fileObj.raw, f)
-                                                                
-                                if myFile.is_file():                                    
-                                    pdf.embed_file( myFile, desc=aFile["name"], compress=True)
-                                    pdf.cell(30, 5, 'Attached file: ', 0, align='L', fill=True)
-                                    pdf.set_text_color(0, 0, 255)
-                                    pdf.cell(0, 5, f'{aFile["id"]}_{aFile["name"]}', 0, align='L', fill=True)
+                                userAttachmentsFilePath = os.path.join( baseUserFilePath, "files/" )
+                                os.makedirs( userAttachmentsFilePath, 0o755, True)
+
+                                for aFile in message["files"]:
+                                    try:
+                                        filePath = os.path.join( userAttachmentsFilePath, f'{aFile["id"]}_{aFile["name"]}' )
+                                        myFile = Path(filePath)
+
+                                        ensureAttachment( aFile, baseUserFilePath, filePath )
+
+                                        if myFile.is_file():                                    
+                                            pdf.embed_file( myFile, desc=aFile["name"], compress=True)
+                                            pdf.cell(30, 5, 'Attached file: ', 0, align='L', fill=True)
+                                            pdf.set_text_color(0, 0, 255)
+                                            pdf.cell(0, 5, f'{aFile["id"]}_{aFile["name"]}', 0, align='L', fill=True)
                                     
-                            except FileException as fe:
-                                print( f'Embed File error: {fe}' )
-                                #traceback.print_exc()
-                            except Exception as e:
-                                print('Embed File error: Couldn\'t add file to PDF')
-                                print( e )
-                                #traceback.print_exc()
-                            finally:
-                                pdf.set_text_color(0, 0, 0)
-                                pdf.ln()
+                                    except FileException as fe:
+                                        print( f'Embed File error: {fe}' )
+                                        #traceback.print_exc()
+                                    except Exception as e:
+                                        print('Embed File error: Couldn\'t add file to PDF')
+                                        print( e )
+                                        #traceback.print_exc()
+                                    finally:
+                                        pdf.set_text_color(0, 0, 0)
+                                        pdf.ln()
                                 
-                    except ImageException as ie:
-                        print( ie )
+                            except ImageException as ie:
+                                print( ie )
 
-        pdfOutput = os.path.join(baseUserPath, f'{options.user}.pdf' )
+        if useVolumes:
+            pdfOutput = os.path.join(baseUserPath, f'{options.user}-vol{volumeNumber:02d}.pdf' )
+            volumeIndex["volumes"].append({ "volume": volumeNumber, "file": os.path.basename(pdfOutput), "pages": pdf.page_no() + 1 })
+        else:
+            pdfOutput = os.path.join(baseUserPath, f'{options.user}.pdf' )
 
-        print( pdfOutput )
-        print()
-        pdf.add_page()
-        pdf.output( pdfOutput )
+        writePDF(pdf, pdfOutput)
+
+        if useVolumes:
+            makeVolumeIndex(options.user, volumeIndex)
+
+        removeStalePDFs(options.user, volumeNumber if useVolumes else 0)
 
         if( options.json ):
-            makeJsonFile(options.user)
+            with profilePhase('json-archive'):
+                makeJsonFile(options.user, options.jsonCompression, options.jsonLevel, options.jsonThreads)
+
+        if httpCacheDir:
+            printHttpCacheStats()
 
     except Exception as e:
         print( e )
         #traceback.print_exc()
 
+    finally:
+        # Keep the manifest of whatever was downloaded, even after a failure
+        if baseUserPath:
+            saveAttachmentManifest(os.path.join( baseUserPath, 'files/' ))
+
+        if profileDir:
+            writeProfileResults()
+
 
 
 #########################
 ## Helper Functions
 ##
 
+def cachedGet(url):
+    '''
+    cachedGet
+
+    GET a JSON endpoint through the on-disk ETag cache. The stored ETag is
+    sent as If-None-Match and a 304 is answered with the stored body.
+    Without a cache directory this is a plain GET.
+
+        @param url the full API URL
+
+        @return (status code, body bytes)
+    '''
+    if not httpCacheDir:
+        response = requests.get(url, headers=headers)
+        return response.status_code, response.content
+
+    cachePath = os.path.join( httpCacheDir, hashlib.sha256(url.encode('utf-8')).hexdigest() )
+    etagPath = f'{cachePath}.etag'
+    bodyPath = f'{cachePath}.body'
+
+    requestHeaders = dict(headers)
+    etag = None
+    if os.path.exists(etagPath) and os.path.exists(bodyPath):
+        with open(etagPath, 'r') as etagFile:
+            etag = etagFile.read()
+        requestHeaders['If-None-Match'] = etag
+
+    response = requests.get(url, headers=requestHeaders)
+
+    if response.status_code == 304 and etag is not None:
+        with open(bodyPath, 'rb') as bodyFile:
+            body = bodyFile.read()
+
+        with httpCacheLock:
+            httpCacheStats['hits'] += 1
+
+        return 200, body
+
+    with httpCacheLock:
+        httpCacheStats['misses'] += 1
+
+    newEtag = response.headers.get('ETag')
+    if response.status_code == 200 and newEtag:
+        # Write to temporary files first so a crash never leaves a body
+        # paired with the wrong ETag
+        tmpSuffix = f'.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(bodyPath + tmpSuffix, 'wb') as bodyFile:
+            bodyFile.write(response.content)
+        with open(etagPath + tmpSuffix, 'w') as etagFile:
+            etagFile.write(newEtag)
+        os.replace(bodyPath + tmpSuffix, bodyPath)
+        os.replace(etagPath + tmpSuffix, etagPath)
+
+    return response.status_code, response.content
+
+
+def printHttpCacheStats():
+    '''
+    printHttpCacheStats
+
+    Print the HTTP cache hit/miss counts and ratio.
+
+    '''
+    hits = httpCacheStats['hits']
+    misses = httpCacheStats['misses']
+    total = hits + misses
+    ratio = (hits / total * 100) if total else 0.0
+
+    print( f'HTTP cache: {hits} hits, {misses} misses, {ratio:.1f}% hit ratio' )
+
+
 def getUser(userID):
     '''
     getUser
@@ -501,13 +720,12 @@ def getUser(userID):
         UserInfoException
     '''
     if userID not in users:
-        getUserResponse = requests.get(f'{mattermostURL}/users/{userID}',
-                                       headers=headers)
+        statusCode, body = cachedGet(f'{mattermostURL}/users/{userID}')
 
-        if (getUserResponse.status_code != 200):
+        if (statusCode != 200):
             raise UserInfoException(f'Failed to get user info for: {userID}')
 
-        users[userID] = getUserResponse.json()
+        users[userID] = json.loads(body)
 
     return users[userID]
 
@@ -587,13 +805,12 @@ def getChannelsForAUser(userID, teamID):
     :raises:
         UserChannelsException
     '''
-    allChannelsForUserResponse = requests.get(f'{mattermostURL}/users/{userID}/teams/{teamID}/channels?include_deleted=false&last_delete_at=0',
-                                              headers=headers)
+    statusCode, body = cachedGet(f'{mattermostURL}/users/{userID}/teams/{teamID}/channels?include_deleted=false&last_delete_at=0')
 
-    if (allChannelsForUserResponse.status_code != 200):
+    if (statusCode != 200):
         raise UserChannelsException('Failed to get channels for user')
 
-    return allChannelsForUserResponse.json()
+    return json.loads(body)
 
 
 def getPostsForChannel(channelID, channelPostsCounter):
@@ -602,18 +819,362 @@ def getPostsForChannel(channelID, channelPostsCounter):
 
     Get all Posts for a Channels
 
+    The body is returned unparsed so it can go straight into the JSON
+    archive, see extractRenderPosts.
+
         @param channelID
         @param channelPostsCounter
 
+        @return raw JSON body bytes
+
     :raises:
         ChannelPostsException
     '''
-    getPostsForChannelResponse = requests.get(f'{mattermostURL}channels/{channelID}/posts?page={channelPostsCounter}', headers=headers)
+    statusCode, body = cachedGet(f'{mattermostURL}channels/{channelID}/posts?page={channelPostsCounter}')
 
-    if (getPostsForChannelResponse.status_code != 200):
+    if (statusCode != 200):
         raise ChannelPostsException('Failed to get posts for channels')
 
-    return getPostsForChannelResponse.json()
+    return body
+
+
+def extractRenderPosts(rawPage):
+    '''
+    extractRenderPosts
+
+    Parse a raw page of posts and keep only the fields the renderer uses,
+    so the full object graph can be freed right away.
+
+        @param rawPage raw JSON body from getPostsForChannel
+
+        @return list of slim posts in page order, empty on the last page
+    '''
+    page = loadPostsJson(rawPage)
+    pagePosts = page["posts"]
+    posts = []
+
+    if not pagePosts:
+        return posts
+
+    for key in page["order"]:
+        fullPost = pagePosts[key]
+        post = { field: fullPost.get(field) for field in renderPostFields }
+
+        if "metadata" in fullPost and "files" in fullPost["metadata"]:
+            post["metadata"] = { "files": fullPost["metadata"]["files"] }
+
+        posts.append(post)
+
+    return posts
+
+
+def loadAttachmentManifest(baseFilePath):
+    '''
+    loadAttachmentManifest
+
+    Load the attachment manifest from a previous export, if any.
+
+        @param baseFilePath the user's files directory
+
+    '''
+    manifestPath = os.path.join( baseFilePath, attachmentManifestName )
+
+    attachmentManifest.clear()
+    if os.path.exists(manifestPath):
+        with open(manifestPath, 'r') as manifestFile:
+            attachmentManifest.update(json.load(manifestFile))
+
+
+def saveAttachmentManifest(baseFilePath):
+    '''
+    saveAttachmentManifest
+
+    Write the attachment manifest next to the downloaded files.
+
+        @param baseFilePath the user's files directory
+
+    '''
+    if not attachmentManifest:
+        return
+
+    os.makedirs( baseFilePath, 0o755, True)
+    manifestPath = os.path.join( baseFilePath, attachmentManifestName )
+
+    with open(f'{manifestPath}.tmp', 'w') as manifestFile:
+        json.dump(attachmentManifest, manifestFile, indent=1, sort_keys=True)
+    os.replace(f'{manifestPath}.tmp', manifestPath)
+
+
+def hashAttachment(filePath):
+    '''
+    hashAttachment
+
+    Return (size, sha256 hex digest) of a file using a memory-mapped read.
+    Returns (None, None) if the file is missing.
+
+        @param filePath
+
+    '''
+    try:
+        with open(filePath, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            digest = hashlib.sha256()
+
+            if size > 0:
+                # memoryview slices hash the mapping without copying it
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                    for offset in range(0, size, attachmentHashBlockSize):
+                        digest.update(view[offset:offset + attachmentHashBlockSize])
+
+            return size, digest.hexdigest()
+
+    except FileNotFoundError:
+        return None, None
+
+
+def downloadAttachment(fileInfo, baseFilePath, filePath):
+    '''
+    downloadAttachment
+
+    Download an attachment to a temporary file, check the received size
+    against metadata.files and move it into place. The manifest entry
+    records the expected size, bytes received and sha256.
+
+        @param fileInfo the file entry from the post metadata
+        @param baseFilePath the user's files directory
+        @param filePath where to store the file
+
+    :raises:
+        FileException
+    '''
+    partPath = f'{filePath}.part'
+    fileObj = getFile( fileInfo["id"] )
+    digest = hashlib.sha256()
+    received = 0
+
+    with open(partPath, 'wb') as f:
+        fileObj.raw.decode_content = True
+        while True:
+            chunk = fileObj.raw.read(1024 * 1024)
+            if not chunk:
+                break
+            f.write(chunk)
+            digest.update(chunk)
+            received += len(chunk)
+
+    expected = fileInfo.get("size")
+    if expected is not None and received != expected:
+        os.remove(partPath)
+        raise FileException(f'Truncated download for file[{fileInfo["id"]}], got {received} of {expected} bytes')
+
+    os.replace(partPath, filePath)
+
+    attachmentManifest[os.path.relpath(filePath, baseFilePath)] = {
+        "id": fileInfo["id"],
+        "size": expected,
+        "received": received,
+        "sha256": digest.hexdigest()
+    }
+
+
+def ensureAttachment(fileInfo, baseFilePath, filePath):
+    '''
+    ensureAttachment
+
+    Make sure an attachment is on disk and complete, downloading it if it
+    is missing or its size does not match the manifest or metadata.
+
+        @param fileInfo the file entry from the post metadata
+        @param baseFilePath the user's files directory
+        @param filePath where the file is stored
+
+    :raises:
+        FileException
+    '''
+    entry = attachmentManifest.get(os.path.relpath(filePath, baseFilePath))
+    expected = fileInfo.get("size")
+
+    if os.path.exists(filePath):
+        size = os.path.getsize(filePath)
+
+        if entry is not None and size == entry["received"] and (expected is None or size == expected):
+            return
+
+        # Left over from an export before the manifest, record it if the size matches
+        if entry is None and expected is not None and size == expected:
+            size, sha256 = hashAttachment(filePath)
+            attachmentManifest[os.path.relpath(filePath, baseFilePath)] = {
+                "id": fileInfo["id"],
+                "size": expected,
+                "received": size,
+                "sha256": sha256
+            }
+            return
+
+    downloadAttachment(fileInfo, baseFilePath, filePath)
+
+
+def verifyAttachments(baseFilePath, workers=None):
+    '''
+    verifyAttachments
+
+    Check the whole attachment tree in parallel, one process per core.
+    Files in the manifest that are missing, truncated or fail the
+    checksum are redownloaded. Files on disk without a manifest entry
+    cannot be checked, so they are reported as unverified and left out of
+    the manifest. Partial downloads left by a crash are removed.
+
+        @param baseFilePath the user's files directory
+        @param workers number of processes, None for all cores
+
+    '''
+    unlistedPaths = []
+    for dirPath, _, fileNames in os.walk(baseFilePath):
+        for fileName in fileNames:
+            filePath = os.path.join( dirPath, fileName )
+            relPath = os.path.relpath(filePath, baseFilePath)
+
+            if fileName.endswith('.part'):
+                print( f'Removing partial download {relPath}' )
+                os.remove(filePath)
+            elif relPath != attachmentManifestName and not fileName.endswith('.tmp') and relPath not in attachmentManifest:
+                unlistedPaths.append(relPath)
+
+    if not attachmentManifest and not unlistedPaths:
+        print('No attachments to verify')
+        return
+
+    relPaths = sorted(attachmentManifest)
+    filePaths = [ os.path.join( baseFilePath, relPath ) for relPath in relPaths ]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(hashAttachment, filePaths, chunksize=16))
+
+    badFiles = []
+    for relPath, filePath, (size, sha256) in zip(relPaths, filePaths, results):
+        entry = attachmentManifest[relPath]
+
+        if size is None or size != entry["received"] or sha256 != entry["sha256"] or (entry["size"] is not None and size != entry["size"]):
+            badFiles.append((relPath, filePath))
+
+    print( f'Verified {len(relPaths)} attachments, {len(badFiles)} bad or missing' )
+
+    if unlistedPaths:
+        print( f'{len(unlistedPaths)} attachments have no manifest entry and could not be verified, rerun the export to check them against the server:' )
+        for relPath in sorted(unlistedPaths):
+            print( f'  {relPath}' )
+
+    for relPath, filePath in badFiles:
+        entry = attachmentManifest[relPath]
+        fileInfo = { "id": entry["id"], "size": entry["size"] }
+
+        try:
+            print( f'Redownloading {relPath}' )
+            os.makedirs( os.path.dirname(filePath), 0o755, True)
+            downloadAttachment(fileInfo, baseFilePath, filePath)
+        except FileException as fe:
+            print( f'Verify error: {fe}' )
+
+    saveAttachmentManifest(baseFilePath)
+
+
+def fetchChannelPosts(channelID):
+    '''
+    fetchChannelPosts
+
+    Get all pages of posts for a channel.
+
+        @param channelID
+
+        @return (list of raw page bytes, list of slim posts oldest to newest)
+
+    :raises:
+        ChannelPostsException
+    '''
+    morePages = True
+    channelPostsCounter = 0
+    allPosts = []
+    allPostsFull = []
+    # Get all pages and append messages to one array.
+    # We reverse this array before processing so order is from older to newest when printing
+
+    while (morePages):
+
+        rawPage = getPostsForChannel(channelID, channelPostsCounter)
+        pagePosts = extractRenderPosts(rawPage)
+
+        if not pagePosts:
+            morePages = False
+
+        channelPostsCounter += 1
+
+        allPosts.extend(pagePosts)
+        allPostsFull.append(rawPage)
+
+    # Reverse so it prints oldest to newest
+    allPosts.reverse()
+
+    return allPostsFull, allPosts
+
+
+def iterFetchedChannels(channels, prefetch):
+    '''
+    iterFetchedChannels
+
+    Yield (channel, raw pages, posts) for each channel in order. With
+    prefetch > 0 a background thread fetches up to that many channels
+    ahead of the caller through a bounded queue, so network waits overlap
+    with PDF layout while the channels held in flight are capped by the
+    queue depth. With -j the raw pages are still kept for the JSON
+    archive.
+
+        @param channels sorted list of channels to export
+        @param prefetch number of channels to fetch ahead, 0 for serial
+
+    :raises:
+        ChannelPostsException
+    '''
+    if prefetch <= 0:
+        for channel in channels:
+            with profilePhase('channel-fetch', channel):
+                allPostsFull, allPosts = fetchChannelPosts(channel["id"])
+            yield channel, allPostsFull, allPosts
+        return
+
+    channelQueue = queue.Queue(maxsize=prefetch)
+    stopEvent = threading.Event()
+
+    def putUnlessStopped(item):
+        while not stopEvent.is_set():
+            try:
+                channelQueue.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetcher():
+        try:
+            for channel in channels:
+                allPostsFull, allPosts = fetchChannelPosts(channel["id"])
+                if not putUnlessStopped((channel, allPostsFull, allPosts, None)):
+                    return
+        except Exception as e: #pylint: disable=broad-except
+            putUnlessStopped((None, None, None, e))
+
+    fetchThread = threading.Thread(target=fetcher, name='channel-fetcher', daemon=True)
+    fetchThread.start()
+
+    try:
+        for _ in channels:
+            channel, allPostsFull, allPosts, error = channelQueue.get()
+            if error is not None:
+                raise error
+            yield channel, allPostsFull, allPosts
+    finally:
+        # Let the fetcher exit if the renderer stopped early
+        stopEvent.set()
+        fetchThread.join()
 
 
 def setupChannelNameAndHeader(channel, userID):
@@ -681,12 +1242,12 @@ def getChannelMembersFn(channel):
     names = ''
     while(morePages):
         getChannelMembers = f'/channels/{channel["id"]}/members?page={channelMembersCounter}'
-        getChannelMembersResponse = requests.get(mattermostURL + getChannelMembers, headers=headers)
+        statusCode, body = cachedGet(mattermostURL + getChannelMembers)
 
-        if (getChannelMembersResponse.status_code != 200):
+        if (statusCode != 200):
             raise ChannelPostsException("ERROR: Getting all posts for channel")
 
-        channelMembers = getChannelMembersResponse.json()
+        channelMembers = json.loads(body)
 
         channelMembersCounter += 1
 
@@ -714,6 +1275,239 @@ def handleUnicode(text):
 
 
 
+def newPDF():
+    '''
+    newPDF
+
+    Create a PDF ready for the first channel.
+
+    '''
+    pdf = PDF()
+    pdf.add_page()
+    pdf.set_auto_page_break(True, 15.0)
+
+    return pdf
+
+
+def writePDF(pdf, pdfOutput):
+    '''
+    writePDF
+
+    Add the closing page and write the PDF to disk.
+
+        @param pdf
+        @param pdfOutput path of the PDF file
+
+    '''
+    print( pdfOutput )
+    print()
+    pdf.add_page()
+
+    with profilePhase('pdf-output'):
+        pdf.output( pdfOutput )
+
+
+def volumeIsFull(pdf, maxPages, maxMB):
+    '''
+    volumeIsFull
+
+    Check if the PDF has reached the page or size cap of a volume.
+
+        @param pdf
+        @param maxPages page cap, 0 for no limit
+        @param maxMB size cap in MB, 0 for no limit
+
+    '''
+    if maxPages > 0 and pdf.page_no() >= maxPages:
+        return True
+
+    if maxMB > 0 and pdf.estimatedSize() >= maxMB * 1024 * 1024:
+        return True
+
+    return False
+
+
+def removeStalePDFs(username, volumeCount):
+    '''
+    removeStalePDFs
+
+    Remove PDFs and the volume index left by an earlier export that was
+    split differently, so only the files of this export remain.
+
+        @param username
+        @param volumeCount number of volumes written, 0 for a single PDF
+
+    '''
+    stalePaths = []
+
+    if volumeCount:
+        stalePaths.append(os.path.join( baseUserPath, f'{username}.pdf' ))
+    else:
+        stalePaths.append(os.path.join( baseUserPath, f'{username}-index.json' ))
+
+    volumePattern = re.compile(rf'{re.escape(username)}-vol(\d+)\.pdf')
+    for fileName in sorted(os.listdir(baseUserPath)):
+        match = volumePattern.fullmatch(fileName)
+        if match and int(match.group(1)) > volumeCount:
+            stalePaths.append(os.path.join( baseUserPath, fileName ))
+
+    for stalePath in stalePaths:
+        if os.path.exists(stalePath):
+            print( f'Removing stale {stalePath}' )
+            os.remove(stalePath)
+
+
+def makeVolumeIndex(username, volumeIndex):
+    '''
+    makeVolumeIndex
+
+    Write the JSON index mapping each category and channel to its volume
+    and page.
+
+        @param username
+        @param volumeIndex dict of volumes and channels
+
+    '''
+    indexPath = os.path.join( baseUserPath, f'{username}-index.json' )
+    print("Writing volume index")
+    print(indexPath)
+    with open(indexPath, 'w') as indexFile:
+        json.dump(volumeIndex, indexFile, indent=1)
+
+
+@contextlib.contextmanager
+def profilePhase(phase, channel=None):
+    '''
+    profilePhase
+
+    Profile a phase of the export with --profile. cProfile stats and time
+    are accumulated per phase, an enclosing phase does not count the time
+    of the phases nested in it. A tracemalloc top-N allocation snapshot
+    is written for one-off phases, for the first call of every per
+    channel phase, and for the outermost phases of sampled channels.
+    Does nothing when profiling is off.
+
+        @param phase name of the phase
+        @param channel the channel being exported, None for one-off phases
+
+    '''
+    if not profileDir:
+        yield
+        return
+
+    channelDir = profileSampledChannels.get(channel["id"], '') if channel is not None else ''
+
+    snapshotDirs = []
+    if channel is None or phase not in profileTimings:
+        snapshotDirs.append(profileDir)
+    # Snapshots are too slow for every call of phases nested in per message loops
+    if channelDir and not profileStack:
+        snapshotDirs.append(channelDir)
+
+    scopeStartTime = time.perf_counter()
+
+    # Only one profiler can be active, pause the enclosing phase
+    if profileStack:
+        profileStack[-1][0].disable()
+
+    profiler = profilePhases.get((phase, channelDir))
+    if profiler is None:
+        profiler = profilePhases[(phase, channelDir)] = cProfile.Profile()
+
+    before = tracemalloc.take_snapshot() if snapshotDirs else None
+    startMemory = tracemalloc.get_traced_memory()[0]
+    scope = [ profiler, 0.0 ]
+    profileStack.append(scope)
+
+    startTime = time.perf_counter()
+    profiler.enable()
+
+    try:
+        yield
+
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - startTime
+        profileStack.pop()
+
+        timing = profileTimings.setdefault(phase, [0, 0.0, 0])
+        timing[0] += 1
+        timing[1] += elapsed - scope[1]
+        timing[2] += tracemalloc.get_traced_memory()[0] - startMemory
+
+        if snapshotDirs:
+            after = tracemalloc.take_snapshot()
+            for snapshotDir in snapshotDirs:
+                writeAllocationSnapshot(snapshotDir, phase, before, after)
+
+        if profileStack:
+            profileStack[-1][1] += time.perf_counter() - scopeStartTime
+            profileStack[-1][0].enable()
+
+
+def writeAllocationSnapshot(snapshotDir, phase, before, after):
+    '''
+    writeAllocationSnapshot
+
+    Append the top allocation sites that grew during a phase to
+    <phase>.tracemalloc.txt.
+
+        @param snapshotDir directory for the report
+        @param phase name of the phase
+        @param before tracemalloc snapshot from the start of the phase
+        @param after tracemalloc snapshot from the end of the phase
+
+    '''
+    filters = [ tracemalloc.Filter(False, tracemalloc.__file__) ]
+    stats = after.filter_traces(filters).compare_to(before.filter_traces(filters), 'lineno')
+
+    os.makedirs( snapshotDir, 0o755, True)
+    with open(os.path.join( snapshotDir, f'{phase}.tracemalloc.txt' ), 'a') as snapshotFile:
+        snapshotFile.write(f'## {phase} {datetime.datetime.now().isoformat()}\n')
+        for stat in stats[:profileTopN]:
+            snapshotFile.write(f'{stat}\n')
+        snapshotFile.write('\n')
+
+
+def writeProfileResults():
+    '''
+    writeProfileResults
+
+    Write a <phase>.pstats file per phase, the per channel pstats of
+    sampled channels and summary.txt with calls, time and traced memory
+    growth per phase.
+
+    '''
+    phaseStats = {}
+
+    for (phase, channelDir), profiler in profilePhases.items():
+        if not profiler.getstats():
+            continue
+
+        if channelDir:
+            os.makedirs( channelDir, 0o755, True)
+            profiler.dump_stats(os.path.join( channelDir, f'{phase}.pstats' ))
+
+        if phase in phaseStats:
+            phaseStats[phase].add(profiler)
+        else:
+            phaseStats[phase] = pstats.Stats(profiler)
+
+    for phase, stats in phaseStats.items():
+        stats.dump_stats(os.path.join( profileDir, f'{phase}.pstats' ))
+
+    summaryPath = os.path.join( profileDir, 'summary.txt' )
+    with open(summaryPath, 'w') as summaryFile:
+        summaryFile.write(f'{"phase":<20} {"calls":>8} {"seconds":>12} {"memory MB":>12}\n')
+        for phase, (calls, seconds, memory) in profileTimings.items():
+            summaryFile.write(f'{phase:<20} {calls:>8} {seconds:>12.3f} {memory / (1024 * 1024):>12.2f}\n')
+
+        if tracemalloc.is_tracing():
+            summaryFile.write(f'\npeak traced memory MB: {tracemalloc.get_traced_memory()[1] / (1024 * 1024):.2f}\n')
+
+    print( f'Profile written to {profileDir}' )
+
+
 class PDF(FPDF):
     def __init__(self):
         super().__init__()
@@ -774,6 +1568,16 @@ class PDF(FPDF):
         self.ln(15)
 
 
+    def estimatedSize(self):
+        # Bytes buffered so far: page content streams, images and embedded files.
+        # This is before compression, the written PDF is usually smaller
+        size = sum(len(page.contents) for page in self.pages.values())
+        size += sum(len(image.get("data", b'')) for image in self.images.values())
+        size += sum(len(getattr(embeddedFile, '_contents', b'')) for embeddedFile in self.embedded_files)
+
+        return size
+
+
     def footer(self):
         # Go to 1.5 cm from bottom
         self.set_y(-15)
@@ -783,21 +1587,223 @@ class PDF(FPDF):
         self.cell(0, 10, f'Page {self.page_no()}', 0, align='C')
 
 
-def makeJsonFile(username):
+def compressJsonBlock(block, codec, level):
+    '''
+    compressJsonBlock
+
+    Compress one independent block of the JSON archive. Each block is a
+    complete gzip member or zstd frame, so concatenated blocks are still
+    a valid stream for the standard tools.
+
+        @param block bytes to compress
+        @param codec 'pigz' or 'zstd'
+        @param level compression level
+
+    '''
+    if codec == 'zstd':
+        # Compressor objects are not thread safe, use one per block
+        return zstandard.ZstdCompressor(level=level).compress(block)
+
+    return gzip.compress(block, compresslevel=level, mtime=0)
+
+
+def decompressJsonBlock(block, codec):
+    '''
+    decompressJsonBlock
+
+    Decompress one block written by compressJsonBlock.
+
+        @param block compressed bytes
+        @param codec 'pigz' or 'zstd'
+
+    '''
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(block)
+
+    return gzip.decompress(block)
+
+
+def iterJsonArchive():
+    '''
+    iterJsonArchive
+
+    Yield the JSON archive as byte chunks. The raw post pages are copied
+    as-is, only the channel ids and names are encoded here.
+
+    '''
+    yield b'{'
+
+    for channelIndex, (channelId, channel) in enumerate(channelCache.items()):
+        if channelIndex:
+            yield b', '
+        yield json.dumps(channelId).encode('ascii')
+        yield b': {"channelName": '
+        yield json.dumps(channel["channelName"]).encode('ascii')
+        yield b', "posts": ['
+
+        for pageIndex, rawPage in enumerate(channel["posts"]):
+            if pageIndex:
+                yield b', '
+            yield rawPage
+
+        yield b']}'
+
+    yield b'}'
+
+
+def makeJsonFile(username, codec='gzip', level=None, threads=1):
     '''
     makeJsonFile
 
     Export the messages as JSON
 
+    The raw post pages are written without re-encoding, see
+    iterJsonArchive. With the pigz and zstd codecs the encoded JSON is
+    cut into blocks that are compressed in parallel and written in order.
+    The block offsets are saved in a .idx file next to the archive so
+    readJsonFile can decompress in parallel too.
+
         @param username
+        @param codec 'gzip', 'pigz' or 'zstd'
+        @param level compression level, None for the codec default
+        @param threads number of compression threads, 0 for all CPUs
 
     '''
     ## PRINT STATEMENT FOR JSON FILE NEEDED
-    jsonPath = os.path.join( baseUserPath, f'{username}.gz' )
+    if level is None:
+        level = jsonCodecDefaultLevels[codec]
+
+    jsonPath = os.path.join( baseUserPath, f'{username}.{jsonCodecExtensions[codec]}' )
     print("Writing JSON to file")
     print(jsonPath)
-    with gzip.open(jsonPath, 'wt', encoding="ascii") as zipfile:
-        json.dump(channelCache, zipfile)
+
+    # An index left by an earlier pigz/zstd run no longer matches the archive
+    indexPath = f'{jsonPath}.idx'
+    if os.path.exists(indexPath):
+        os.remove(indexPath)
+
+    if codec == 'gzip':
+        with gzip.open(jsonPath, 'wb', compresslevel=level) as zipfile:
+            for chunk in iterJsonArchive():
+                zipfile.write(chunk)
+        return
+
+    threads = threads or os.cpu_count() or 1
+    blocks = []
+    offset = 0
+
+    with open(jsonPath, 'wb') as zipfile, concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = []
+
+        def writeBlock(future):
+            nonlocal offset
+            compressed = future.result()
+            zipfile.write(compressed)
+            blocks.append([offset, len(compressed)])
+            offset += len(compressed)
+
+        def submitBlock(chunks):
+            block = b''.join(chunks)
+            pending.append(executor.submit(compressJsonBlock, block, codec, level))
+
+            # Bound the blocks held in memory, write the oldest in order
+            while len(pending) > threads * 2:
+                writeBlock(pending.pop(0))
+
+        chunks = []
+        chunksSize = 0
+        for chunk in iterJsonArchive():
+            chunks.append(chunk)
+            chunksSize += len(chunk)
+
+            if chunksSize >= jsonBlockSize:
+                submitBlock(chunks)
+                chunks = []
+                chunksSize = 0
+
+        if chunks:
+            submitBlock(chunks)
+
+        for future in pending:
+            writeBlock(future)
+
+    with open(f'{indexPath}.tmp', 'w') as indexFile:
+        json.dump({ "codec": codec, "blocks": blocks }, indexFile)
+    os.replace(f'{indexPath}.tmp', indexPath)
+
+
+def readJsonFile(jsonPath, threads=1):
+    '''
+    readJsonFile
+
+    Load a JSON archive written by makeJsonFile. If a .idx file is present
+    the blocks are decompressed in parallel, otherwise the archive is
+    streamed through gzip or zstandard.
+
+        @param jsonPath path to the .gz or .zst archive
+        @param threads number of decompression threads, 0 for all CPUs
+
+    :raises:
+        JsonArchiveException
+    '''
+    indexPath = f'{jsonPath}.idx'
+    isZstd = jsonPath.endswith('.zst')
+
+    if isZstd and zstandard is None:
+        raise JsonArchiveException( f'zstandard module is needed to read {jsonPath}' )
+
+    try:
+        if os.path.exists(indexPath):
+            with open(indexPath) as indexFile:
+                index = json.load(indexFile)
+
+            with open(jsonPath, 'rb') as zipfile:
+                data = zipfile.read()
+
+            codec = index["codec"]
+            blocks = [ data[offset:offset + length] for offset, length in index["blocks"] ]
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as executor:
+                decoded = b''.join(executor.map(lambda block: decompressJsonBlock(block, codec), blocks))
+
+            return json.loads(decoded.decode('utf-8'))
+
+        if isZstd:
+            with open(jsonPath, 'rb') as zipfile:
+                reader = zstandard.ZstdDecompressor().stream_reader(zipfile, read_across_frames=True)
+                return json.loads(reader.read().decode('utf-8'))
+
+        with gzip.open(jsonPath, 'rt', encoding="utf-8") as zipfile:
+            return json.load(zipfile)
+
+    except jsonArchiveReadErrors as e:
+        raise JsonArchiveException( f'Failed to read JSON archive {jsonPath}: {e}' )
+
+
+def printJsonFileSummary(username, codec, threads=1):
+    '''
+    printJsonFileSummary
+
+    Read back the user's JSON archive and print the posts per channel.
+
+        @param username
+        @param codec 'gzip', 'pigz' or 'zstd', picks the file extension
+        @param threads number of decompression threads, 0 for all CPUs
+
+    :raises:
+        JsonArchiveException
+    '''
+    jsonPath = os.path.join( baseUserPath, f'{username}.{jsonCodecExtensions[codec]}' )
+    print("Reading JSON from file")
+    print(jsonPath)
+
+    archive = readJsonFile(jsonPath, threads)
+
+    for channel in archive.values():
+        postCount = sum(len(page["order"]) for page in channel["posts"])
+        print( f'{channel["channelName"]}: {postCount} posts' )
+
+    print( f'Total Channels: {len(archive)}' )
 
 
 if __name__ == '__main__':